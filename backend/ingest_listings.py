@@ -1,364 +1,441 @@
 import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Intra-op threads per process: the cores split across uvicorn workers
+# (WEB_CONCURRENCY), capped at 4 since on many-core CPUs more threads spend
+# more time synchronising than encoding. TORCH_THREADS overrides.
+TORCH_THREADS = int(os.getenv('TORCH_THREADS') or max(
+    1, min(4, (os.cpu_count() or 1) // int(os.getenv('WEB_CONCURRENCY', '1')))
+))
+
+# OpenMP and MKL size their pools when torch is imported, so these must be
+# set first; explicit environment settings still win
+os.environ.setdefault('OMP_NUM_THREADS', str(TORCH_THREADS))
+os.environ.setdefault('MKL_NUM_THREADS', str(TORCH_THREADS))
+
 import json
+import threading
 import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 from sentence_transformers import SentenceTransformer
 from google.cloud import firestore
 from google.oauth2 import service_account
-from dotenv import load_dotenv
+from semantic_text import create_semantic_text, semantic_text_hash
 
-load_dotenv()
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+# Larger batches keep a GPU busy; on CPU they only add padding
+encode_batch_size = 128 if device == 'cuda' else 64
+
+# The model and Firestore client are created on first use and then shared by
+# everything in the process (this script and the API)
+_model = None
+_db = None
 
-# Initialize multilingual MPNet model
-print("Loading multilingual MPNet model...")
-model = SentenceTransformer('sentence-transformers/paraphrase-multilingual-mpnet-base-v2')
-print("Multilingual model loaded successfully!")
+def get_model():
+    """Load the multilingual MPNet model on first use and return it"""
+    global _model
+    if _model is None:
+        # Apply the thread budget; must run before the model is created
+        torch.set_num_threads(TORCH_THREADS)
+        torch.set_num_interop_threads(1)
+        
+        # MODEL_BACKEND=onnx or openvino runs inference through ONNX Runtime /
+        # OpenVINO; install the matching extra as well, e.g.
+        # pip install "sentence-transformers[onnx]==3.2.1". MODEL_FILE_NAME
+        # selects a specific exported file, e.g. a quantized one.
+        model_backend = os.getenv('MODEL_BACKEND', 'torch')
+        model_kwargs = {}
+        if model_backend != 'torch':
+            model_kwargs['backend'] = model_backend
+            if os.getenv('MODEL_FILE_NAME'):
+                model_kwargs['model_kwargs'] = {'file_name': os.getenv('MODEL_FILE_NAME')}
+        
+        print(f"Loading multilingual MPNet model ({model_backend} backend, {device})...")
+        _model = SentenceTransformer('sentence-transformers/paraphrase-multilingual-mpnet-base-v2', device=device, **model_kwargs)
+        if device == 'cuda' and model_backend == 'torch':
+            # FP16 halves activation memory traffic on GPU
+            _model.half()
+        
+        # sentence-transformers loads the Rust-backed fast tokenizer when one
+        # exists; the pure-Python fallback can dominate short-query latency
+        tokenizer = _model.tokenizer
+        if not getattr(tokenizer, 'is_fast', False):
+            print(f"Warning: slow tokenizer in use ({type(tokenizer).__name__}); install `tokenizers` for the fast one")
+        print(f"Multilingual model loaded successfully! Tokenizer: {type(tokenizer).__name__}")
+    return _model
 
-# Initialize Firestore
-service_account_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
-project_id = os.getenv('FIRESTORE_PROJECT_ID')
+def get_db():
+    """Create the Firestore client on first use and return it"""
+    global _db
+    if _db is None:
+        service_account_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+        service_account_json = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
+        project_id = os.getenv('FIRESTORE_PROJECT_ID')
+        
+        if service_account_json:
+            # For Render deployment - credentials from environment variable JSON string
+            credentials_dict = json.loads(service_account_json)
+            credentials = service_account.Credentials.from_service_account_info(credentials_dict)
+            _db = firestore.Client(credentials=credentials, project=project_id)
+        elif service_account_path and os.path.exists(service_account_path):
+            # For local development - credentials from file
+            credentials = service_account.Credentials.from_service_account_file(service_account_path)
+            _db = firestore.Client(credentials=credentials, project=project_id)
+        else:
+            # Fallback to default credentials
+            _db = firestore.Client(project=project_id)
+    return _db
 
-if service_account_path and os.path.exists(service_account_path):
-    credentials = service_account.Credentials.from_service_account_file(service_account_path)
-    db = firestore.Client(credentials=credentials, project=project_id)
-else:
-    db = firestore.Client(project=project_id)
+# Listing fields read during ingestion: semantic text inputs plus the text hash
+SEMANTIC_FIELDS = ['name', 'livestockTypes', 'details', 'description', 'semantic_text_sha1']
 
-def normalize_livestock_type(livestock_type):
+def fetch_listings(db):
     """
-    Normalize livestock type to standard format for consistent embedding generation.
+    Read all listings, fetching partitions of the collection concurrently.
+    
+    Only the fields that feed the semantic text are read; the stored embedding
+    itself is never needed to decide whether to re-encode. INGEST_READ_PARTITIONS
+    opts in to partitioned reads with that many partitions (the default, 1,
+    streams the collection directly).
     
     Args:
-        livestock_type: Raw livestock type string
+        db: Firestore client
         
     Returns:
-        str: Normalized livestock type
+        list: Document snapshots for every listing
     """
-    if not livestock_type:
-        return ''
+    partition_count = int(os.getenv('INGEST_READ_PARTITIONS', '1'))
+    if partition_count <= 1:
+        return list(db.collection('livestock_listings').select(SEMANTIC_FIELDS).stream())
     
-    normalized = livestock_type.lower().strip()
+    # Partitioned queries are only available on collection groups
+    partitions = list(db.collection_group('livestock_listings').get_partitions(partition_count))
     
-    # Mapping to standard types
-    type_map = {
-        # Cattle variations
-        'cow': 'cattle',
-        'cows': 'cattle',
-        'cattle': 'cattle',
-        'beef cattle': 'cattle',
-        'dairy cattle': 'cattle',
-        'dairy cow': 'cattle',
-        'beef cow': 'cattle',
-        'baka': 'cattle',
-        
-        # Buffalo/Carabao variations
-        'carabao': 'buffalo',
-        'water buffalo': 'buffalo',
-        'buffalo': 'buffalo',
-        'kalabaw': 'buffalo',
-        'kabaw': 'buffalo',
-        
-        # Pig/Swine variations
-        'pig': 'pigs',
-        'pigs': 'pigs',
-        'swine': 'pigs',
-        'hog': 'pigs',
-        'hogs': 'pigs',
-        'baboy': 'pigs',
-        
-        # Chicken/Poultry variations
-        'chicken': 'chickens',
-        'chickens': 'chickens',
-        'poultry': 'chickens',
-        'hen': 'chickens',
-        'hens': 'chickens',
-        'rooster': 'chickens',
-        'broiler': 'chickens',
-        'layer': 'chickens',
-        'manok': 'chickens',
-        'quail': 'chickens',
-        'pugo': 'chickens',
-        'turkey': 'chickens',
-        'pabo': 'chickens',
-        'goose': 'chickens',
-        'gansa': 'chickens',
-        
-        # Goat variations
-        'goat': 'goats',
-        'goats': 'goats',
-        'kambing': 'goats',
-        'kanding': 'goats',
-        
-        # Sheep variations
-        'sheep': 'sheep',
-        'tupa': 'sheep',
-        
-        # Rabbit variations
-        'rabbit': 'rabbits',
-        'rabbits': 'rabbits',
-        'kuneho': 'rabbits',
-        
-        # Horse variations
-        'horse': 'horses',
-        'horses': 'horses',
-        'kabayo': 'horses',
-        
-        # Duck variations
-        'duck': 'ducks',
-        'ducks': 'ducks',
-        'pato': 'ducks',
-        
-        # Other/Others - map to general livestock
-        'other': 'livestock',
-        'others': 'livestock',
-        'iba': 'livestock'
-    }
+    def fetch_partition(partition):
+        # The collection group also spans any nested livestock_listings
+        # subcollection; keep only documents of the top-level collection
+        docs = partition.query().select(SEMANTIC_FIELDS).stream()
+        return [doc for doc in docs if doc.reference.parent.parent is None]
     
-    return type_map.get(normalized, normalized)
-
+    with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+        results = executor.map(fetch_partition, partitions)
+        return [doc for docs in results for doc in docs]
 
-def clean_agricultural_description(description):
+def fetch_listings_by_id(db, listing_ids):
     """
-    Clean description to extract only agricultural and farming-relevant information.
-    Removes pricing, payment, delivery, and logistics details.
+    Read specific listings in one batched get_all call.
     
     Args:
-        description: Raw description text
+        db: Firestore client
+        listing_ids: Listing document ids
         
     Returns:
-        str: Cleaned description focusing on agricultural intent
+        list: Document snapshots for the listings that exist
     """
-    if not description:
-        return ''
-    
-    # Convert to lowercase for processing
-    desc_lower = description.lower()
-    
-    # Keywords to exclude (pricing, payment, delivery, logistics)
-    exclude_keywords = [
-        'price', 'cost', 'payment', 'pay', 'pesos', 'php', '₱',
-        'delivery', 'shipping', 'transport', 'pickup', 'meet',
-        'contact', 'call', 'text', 'message', 'whatsapp', 'viber',
-        'available', 'stock', 'quantity', 'kg', 'sack', 'bag',
-        'location', 'address', 'area', 'barangay', 'city',
-        'negotiable', 'fixed', 'cash', 'gcash', 'bank'
-    ]
+    listings_ref = db.collection('livestock_listings')
+    refs = [listings_ref.document(listing_id) for listing_id in dict.fromkeys(listing_ids)]
+    return [doc for doc in db.get_all(refs, field_paths=SEMANTIC_FIELDS) if doc.exists]
+
+def encode_texts(texts, model, show_progress=True):
+    """
+    Encode semantic texts, fanning out over a multi-process pool for large runs.
     
-    # Split into sentences
-    sentences = description.split('.')
+    The pool is used when more than one GPU is present, or when ENCODE_WORKERS
+    asks for several CPU worker processes, and there are at least
+    ENCODE_POOL_MIN_TEXTS texts; below that, pool startup costs more than it saves.
     
-    # Keep only sentences that focus on agricultural use
-    agricultural_sentences = []
-    for sentence in sentences:
-        sentence_lower = sentence.lower().strip()
-        
-        # Skip if contains excluded keywords
-        if any(keyword in sentence_lower for keyword in exclude_keywords):
-            continue
-        
-        # Keep if contains agricultural keywords
-        agricultural_keywords = [
-            'crop', 'plant', 'farm', 'soil', 'fertilizer', 'organic',
-            'compost', 'manure', 'nutrient', 'nitrogen', 'phosphorus',
-            'potassium', 'vegetable', 'rice', 'corn', 'fruit', 'garden',
-            'grow', 'harvest', 'yield', 'quality', 'rich', 'natural',
-            'tanim', 'pananim', 'pataba', 'lupa', 'organiko'
-        ]
+    Args:
+        texts: List of semantic texts
+        model: SentenceTransformer used for encoding
+        show_progress: Show a progress bar while encoding
         
-        if any(keyword in sentence_lower for keyword in agricultural_keywords):
-            agricultural_sentences.append(sentence.strip())
-    
-    # Join agricultural sentences
-    cleaned = ' '.join(agricultural_sentences)
+    Returns:
+        np.ndarray: One L2-normalized embedding row per text, in input order
+    """
+    pool_devices = None
+    if torch.cuda.device_count() > 1:
+        pool_devices = [f'cuda:{i}' for i in range(torch.cuda.device_count())]
+    elif int(os.getenv('ENCODE_WORKERS', '1')) > 1:
+        pool_devices = ['cpu'] * int(os.getenv('ENCODE_WORKERS'))
     
-    # Remove extra whitespace
-    cleaned = ' '.join(cleaned.split())
+    if pool_devices and len(texts) >= int(os.getenv('ENCODE_POOL_MIN_TEXTS', '5000')):
+        print(f"Encoding with a {len(pool_devices)}-process pool")
+        pool = model.start_multi_process_pool(pool_devices)
+        try:
+            embeddings = model.encode_multi_process(texts, pool, batch_size=encode_batch_size)
+        finally:
+            model.stop_multi_process_pool(pool)
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
     
-    return cleaned
+    with torch.inference_mode():
+        return model.encode(
+            texts,
+            batch_size=encode_batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=show_progress
+        )
 
-
-def create_semantic_text(listing_data):
+def encode_normalized(model, texts, batch_size=32):
     """
-    Generate semantic embedding text for livestock waste listing.
+    Encode one text or a list of texts for an online request.
     
-    Uses livestock type as reliable context anchor and incorporates user description
-    to capture agricultural intent. Focuses on waste source, crop usability, and
-    farming relevance. Excludes pricing, payment, delivery, and logistics.
+    Runs under inference_mode with the progress bar off, so short requests
+    pay no autograd or tqdm setup.
     
     Args:
-        listing_data: Dictionary containing listing information
+        model: SentenceTransformer used for encoding
+        texts: A single text or a list of texts
+        batch_size: Texts per forward pass
         
     Returns:
-        str: Clean, neutral English text optimized for agricultural semantic search
+        np.ndarray: L2-normalized embedding (or one row per text)
     """
-    parts = []
+    with torch.inference_mode():
+        return model.encode(
+            texts,
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+
+# gRPC status codes of transient write errors (DEADLINE_EXCEEDED,
+# RESOURCE_EXHAUSTED, ABORTED, INTERNAL, UNAVAILABLE); anything else, such as
+# PERMISSION_DENIED or NOT_FOUND, fails the write at once
+RETRYABLE_WRITE_CODES = (4, 8, 10, 13, 14)
+MAX_WRITE_ATTEMPTS = 10
+
+class WriteTracker:
+    """
+    Queue updates on a BulkWriter and record the outcome of each one.
     
-    # 1. LIVESTOCK TYPE (Primary Context Anchor)
-    # This is the most reliable field - use it as the foundation
-    livestock_types = listing_data.get('livestockTypes', [])
-    if livestock_types:
-        # Normalize and expand livestock types for better matching
-        livestock_context = []
-        for livestock in livestock_types:
-            normalized = normalize_livestock_type(livestock)
-            livestock_context.append(normalized)
-            
-            # Add agricultural context for each livestock type
-            if normalized in ['chickens', 'poultry']:
-                livestock_context.append('poultry manure high nitrogen organic fertilizer')
-            elif normalized in ['cattle', 'cow']:
-                livestock_context.append('cattle manure balanced nutrients soil improvement')
-            elif normalized in ['pigs', 'swine']:
-                livestock_context.append('pig manure high phosphorus crop fertilizer')
-            elif normalized in ['goats']:
-                livestock_context.append('goat manure potassium rich vegetable fertilizer')
-            elif normalized in ['rabbits']:
-                livestock_context.append('rabbit manure gentle nutrients cold manure')
-            elif normalized in ['buffalo', 'carabao']:
-                livestock_context.append('buffalo manure organic matter paddy field fertilizer')
-            elif normalized in ['horses']:
-                livestock_context.append('horse manure mushroom substrate garden fertilizer')
-            elif normalized in ['sheep']:
-                livestock_context.append('sheep manure dry pellets organic fertilizer')
-            elif normalized in ['ducks']:
-                livestock_context.append('duck manure aquatic bird fertilizer')
-        
-        parts.extend(livestock_context)
+    BulkWriter drops writes that fail for good and close() does not raise,
+    so successes and failures are counted through its callbacks instead.
+    When a whole batch RPC fails (permission denied, network loss) neither
+    callback fires, so writes still unaccounted for after close() are
+    counted as failed too.
+    """
+    
+    def __init__(self, bulk_writer):
+        self.bulk_writer = bulk_writer
+        self.queued = 0
+        self.written = 0
+        self.failed = []
+        # Document path -> id of every write without an outcome yet
+        self.pending = {}
+        self.lock = threading.Lock()
+        bulk_writer.on_write_result(self.on_result)
+        bulk_writer.on_write_error(self.on_error)
     
-    # 2. WASTE TYPE IDENTIFICATION
-    # Extract waste type from name or infer from context
-    name = listing_data.get('name', '').lower()
-    if 'manure' in name or 'dumi' in name:
-        parts.append('animal manure livestock waste organic fertilizer')
-    if 'compost' in name or 'composted' in name:
-        parts.append('composted organic matter soil amendment')
-    if 'egg' in name or 'itlog' in name or 'shell' in name:
-        parts.append('eggshells calcium rich poultry waste')
-    if 'bedding' in name or 'litter' in name:
-        parts.append('animal bedding livestock litter organic material')
-    if 'vermi' in name or 'worm' in name:
-        parts.append('vermicompost worm castings premium organic fertilizer')
+    def update(self, reference, data):
+        """Queue an update of one document"""
+        with self.lock:
+            self.queued += 1
+            self.pending[reference.path] = reference.id
+        self.bulk_writer.update(reference, data)
     
-    # 3. AGRICULTURAL INTENT FROM DESCRIPTION
-    # Clean and extract farming-relevant information only
-    description = listing_data.get('details', '') or listing_data.get('description', '')
-    if description:
-        cleaned_desc = clean_agricultural_description(description)
-        if cleaned_desc:
-            parts.append(cleaned_desc)
+    def close(self):
+        """Wait for every queued write, then count writes with no reported outcome as failed"""
+        self.bulk_writer.close()
+        with self.lock:
+            if self.pending:
+                print(f"{len(self.pending)} writes were lost with their batch")
+                self.failed.extend(self.pending.values())
+                self.pending.clear()
     
-    # 4. GENERAL CROP SUITABILITY
-    # Add general agricultural use context if not already specified
-    if not any(crop in ' '.join(parts).lower() for crop in ['rice', 'corn', 'vegetable', 'fruit', 'crop']):
-        parts.append('suitable for crops vegetables rice corn general farming use')
+    def on_result(self, reference, result, bulk_writer):
+        with self.lock:
+            self.written += 1
+            self.pending.pop(reference.path, None)
     
-    # 5. ORGANIC FARMING CONTEXT
-    # Emphasize organic and sustainable farming
-    parts.append('organic fertilizer sustainable agriculture soil health improvement')
+    def on_error(self, error, bulk_writer):
+        if error.code in RETRYABLE_WRITE_CODES and error.attempts < MAX_WRITE_ATTEMPTS:
+            return True
+        reference = error.operation.reference
+        with self.lock:
+            self.failed.append(reference.id)
+            self.pending.pop(reference.path, None)
+        print(f"Write failed for {reference.id}: {error.message}")
+        return False
     
-    # 6. TAGALOG-ENGLISH MAPPINGS (for multilingual search)
-    # Add English equivalents for common Tagalog terms
-    if 'kambing' in name or 'kanding' in name:
-        parts.append('goat')
-    if 'manok' in name:
-        parts.append('chicken poultry')
-    if 'baboy' in name:
-        parts.append('pig swine')
-    if 'baka' in name:
-        parts.append('cattle cow')
-    if 'kalabaw' in name or 'kabaw' in name:
-        parts.append('buffalo carabao')
-    if 'kuneho' in name:
-        parts.append('rabbit')
-    if 'kabayo' in name:
-        parts.append('horse')
-    if 'tupa' in name:
-        parts.append('sheep')
-    if 'pato' in name:
-        parts.append('duck')
+    def check(self):
+        """Raise if writes were queued and none of them succeeded"""
+        if self.queued and not self.written:
+            raise RuntimeError(f"All {self.queued} writes failed; first failure: {self.failed[0]}")
+
+def ingest_listings(model=None, db=None, listing_ids=None, show_progress=True):
+    """
+    Generate and store MPNet embeddings for all livestock listings.
     
-    # Join all parts and clean up
-    semantic_text = ' '.join(parts)
+    Args:
+        model: SentenceTransformer to encode with (defaults to get_model())
+        db: Firestore client (defaults to get_db())
+        listing_ids: Only process these listings (defaults to all listings)
+        show_progress: Show progress bars (off when run inside the API)
+        
+    Returns:
+        dict: Counts of processed, unchanged, skipped, and failed listings,
+            plus the ids of failed listings
     
-    # Remove duplicates while preserving order
-    words = semantic_text.split()
-    seen = set()
-    unique_words = []
-    for word in words:
-        word_lower = word.lower()
-        if word_lower not in seen:
-            seen.add(word_lower)
-            unique_words.append(word)
+    Raises:
+        RuntimeError: If every embedding write failed
+    """
+    if model is None:
+        model = get_model()
+    if db is None:
+        db = get_db()
     
-    return ' '.join(unique_words)
-
-def ingest_listings():
-    """Generate and store MPNet embeddings for all livestock listings"""
+    processed_count = 0
     try:
         print("Starting ingestion process...")
         
-        # Get all listings from Firestore
-        listings_ref = db.collection('livestock_listings')
-        docs = listings_ref.stream()
-        
-        # Convert to list and process in batches
-        all_docs = list(docs)
+        # Get the listings from Firestore
+        if listing_ids is None:
+            all_docs = fetch_listings(db)
+        else:
+            all_docs = fetch_listings_by_id(db, listing_ids)
         total_listings = len(all_docs)
         print(f"Found {total_listings} listings to process")
         
-        processed_count = 0
+        # Build semantic texts first so the whole run is encoded in one batched call
+        texts = []
+        text_rows = {}
+        rows = []
+        hashes = []
+        refs = []
         skipped_count = 0
-        batch_size = 50  # Process 50 listings at a time
+        unchanged_count = 0
+        updated_count = 0
         
-        for batch_start in range(0, total_listings, batch_size):
-            batch_end = min(batch_start + batch_size, total_listings)
-            batch_docs = all_docs[batch_start:batch_end]
+        for doc in tqdm(all_docs, desc='Preparing', disable=not show_progress):
+            listing_data = doc.to_dict()
             
-            print(f"\nProcessing batch {batch_start//batch_size + 1}/{(total_listings-1)//batch_size + 1} (listings {batch_start+1}-{batch_end})")
+            # Create semantic text
+            semantic_text = create_semantic_text(listing_data)
             
-            for doc in batch_docs:
-                listing_data = doc.to_dict()
-                listing_id = doc.id
-                
-                # Check if embedding already exists (force regenerate for multilingual model)
-                if 'mpnet_embedding' in listing_data:
-                    print(f"Updating {listing_id} - regenerating with multilingual model")
-                else:
-                    print(f"Processing {listing_id} - new embedding")
-                
-                # Create semantic text
-                semantic_text = create_semantic_text(listing_data)
-                
-                if not semantic_text.strip():
-                    print(f"Skipping {listing_id} - no semantic text available")
-                    skipped_count += 1
-                    continue
-                
-                # Generate embedding
-                embedding = model.encode(semantic_text, convert_to_numpy=True)
-                
-                # Update document with embedding
-                doc.reference.update({
-                    'mpnet_embedding': embedding.tolist()
-                })
-                
-                processed_count += 1
-                print(f"Processed {doc.id} - embedding stored")
+            if not semantic_text.strip():
+                skipped_count += 1
+                continue
             
-            # Progress indicator
-            print(f"Batch complete. Total processed: {processed_count}/{total_listings}")
+            # Skip listings whose stored embedding was built from the same text.
+            # The hash is only ever written together with the embedding.
+            text_hash = semantic_text_hash(semantic_text)
+            stored_hash = listing_data.get('semantic_text_sha1')
+            if stored_hash == text_hash:
+                unchanged_count += 1
+                continue
             
-            # Small delay between batches to avoid rate limiting
-            import time
-            time.sleep(1)
+            if stored_hash:
+                updated_count += 1
+            
+            # Listings that share a semantic text share one encoded row
+            if semantic_text not in text_rows:
+                text_rows[semantic_text] = len(texts)
+                texts.append(semantic_text)
+            rows.append(text_rows[semantic_text])
+            hashes.append(text_hash)
+            refs.append(doc.reference)
+        
+        # Generate all embeddings at once. encode() sorts its input by length
+        # before batching and restores the original order afterwards, so a
+        # single call over the whole run keeps padding per batch to a minimum.
+        print(f"\nEncoding {len(texts)} unique semantic texts for {len(refs)} listings...")
+        embeddings = encode_texts(texts, model, show_progress=show_progress)
+        
+        # Store embeddings through a BulkWriter, which pipelines the updates as
+        # concurrent batched commits and throttles/backs off on its own
+        writes = WriteTracker(db.bulk_writer())
+        
+        try:
+            for ref, row, text_hash in tqdm(zip(refs, rows, hashes), total=len(refs), desc='Writing', disable=not show_progress):
+                embedding = embeddings[row]
+                
+                # Queue update with the float16-packed embedding and the hash
+                # of its source text, dropping the legacy float list field
+                writes.update(ref, {
+                    'mpnet_embedding_f16': embedding.astype(np.float16).tobytes(),
+                    'mpnet_embedding': firestore.DELETE_FIELD,
+                    'semantic_text_sha1': text_hash
+                })
+        finally:
+            # Waits for every queued write to complete
+            writes.close()
+        processed_count = writes.written
+        writes.check()
         
         print(f"\nIngestion complete!")
-        print(f"Processed: {processed_count} listings")
+        print(f"Processed: {processed_count} listings ({updated_count} re-embedded after a text change)")
+        print(f"Unchanged: {unchanged_count} listings")
         print(f"Skipped: {skipped_count} listings")
+        print(f"Failed: {len(writes.failed)} listings")
+        
+        return {
+            'processed': processed_count,
+            'unchanged': unchanged_count,
+            'skipped': skipped_count,
+            'failed': len(writes.failed),
+            'failed_ids': writes.failed
+        }
         
     except Exception as e:
         print(f"Error during ingestion: {e}")
         print(f"Progress so far: {processed_count} listings processed")
         raise
 
+def migrate_legacy_embeddings(db=None, show_progress=True):
+    """
+    Convert legacy float-list embeddings to the normalized float16 format.
+    
+    Listings embedded before the float16 format carry an unnormalized
+    `mpnet_embedding` list. Each is rewritten as L2-normalized float16 bytes
+    without re-encoding. No text hash is written, because the stored vector
+    may come from an older semantic text, so the next ingestion run still
+    re-checks these listings.
+    
+    Args:
+        db: Firestore client (defaults to get_db())
+        show_progress: Show a progress bar (off when run inside the API)
+        
+    Returns:
+        dict: Counts of migrated and failed listings, plus the failed ids
+    
+    Raises:
+        RuntimeError: If every rewrite failed
+    """
+    if db is None:
+        db = get_db()
+    
+    docs = db.collection('livestock_listings').select(['mpnet_embedding']).stream()
+    writes = WriteTracker(db.bulk_writer())
+    
+    try:
+        for doc in tqdm(docs, desc='Migrating', disable=not show_progress):
+            legacy = doc.to_dict().get('mpnet_embedding')
+            if not legacy:
+                continue
+            
+            embedding = np.asarray(legacy, dtype=np.float32)
+            norm = np.linalg.norm(embedding)
+            if norm > 0:
+                embedding /= norm
+            
+            writes.update(doc.reference, {
+                'mpnet_embedding_f16': embedding.astype(np.float16).tobytes(),
+                'mpnet_embedding': firestore.DELETE_FIELD
+            })
+    finally:
+        # Waits for every queued write to complete
+        writes.close()
+    writes.check()
+    
+    print(f"Migrated {writes.written} legacy embeddings to float16 ({len(writes.failed)} failed)")
+    return {'migrated': writes.written, 'failed': len(writes.failed), 'failed_ids': writes.failed}
+
 if __name__ == "__main__":
     ingest_listings()
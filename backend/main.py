@@ -1,19 +1,55 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field
 from typing import List, Optional
+# Imported first: it sets the OpenMP/MKL thread budget, which must happen
+# before numpy, faiss and torch load their native thread pools
+from ingest_listings import ingest_listings, migrate_legacy_embeddings, encode_normalized, get_model, get_db
 import os
-import json
+import base64
+import hmac
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 import numpy as np
-from sentence_transformers import SentenceTransformer
 from google.cloud import firestore
-from google.oauth2 import service_account
-from dotenv import load_dotenv
 import asyncio
+from semantic_text import create_semantic_text, semantic_text_hash
+from search_index import EMBEDDING_FIELDS, INTERNAL_FIELDS, ListingIndex, EncodeBatcher, SemanticSearchCache
 
-load_dotenv()
+# Firestore client shared with the ingestion code (credentials from
+# GOOGLE_APPLICATION_CREDENTIALS_JSON, GOOGLE_APPLICATION_CREDENTIALS, or defaults)
+db = get_db()
 
-app = FastAPI(title="AgriLink Semantic Search API")
+@asynccontextmanager
+async def lifespan(app):
+    """Load the model and build the search index once per worker before serving"""
+    # Shares the ingestion loader, so MODEL_BACKEND=onnx/openvino (with
+    # MODEL_FILE_NAME for a quantized export), GPU FP16 and TORCH_THREADS
+    # apply to the API as well
+    app.state.model = await asyncio.to_thread(get_model)
+    encode_batcher.start()
+    sync_task = asyncio.create_task(sync_listing_index())
+    
+    # Fail startup instead of hanging when the first load never completes
+    # (bad credentials, missing permissions, a listen stream that won't open)
+    loaded = await asyncio.to_thread(listing_index.loaded.wait, INDEX_LOAD_TIMEOUT_SECONDS)
+    if not loaded:
+        sync_task.cancel()
+        raise RuntimeError(f"Search index not loaded within {INDEX_LOAD_TIMEOUT_SECONDS:g}s; check Firestore access")
+    print(f"Search index loaded with {len(listing_index.ids)} listings")
+    yield
+    sync_task.cancel()
+
+# orjson renders the float-heavy embedding and search responses several
+# times faster than the stdlib encoder
+app = FastAPI(
+    title="AgriLink Semantic Search API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # Add CORS middleware
 app.add_middleware(
@@ -24,338 +60,357 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize MPNet model (multilingual version)
-print("Loading multilingual MPNet model...")
-model = SentenceTransformer('sentence-transformers/paraphrase-multilingual-mpnet-base-v2')
-print("Multilingual model loaded successfully!")
-
-# Initialize Firestore
-service_account_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
-service_account_json = os.getenv('GOOGLE_APPLICATION_CREDENTIALS_JSON')
-project_id = os.getenv('FIRESTORE_PROJECT_ID')
-
-if service_account_json:
-    # For Render deployment - credentials from environment variable JSON string
-    credentials_dict = json.loads(service_account_json)
-    credentials = service_account.Credentials.from_service_account_info(credentials_dict)
-    db = firestore.Client(credentials=credentials, project=project_id)
-elif service_account_path and os.path.exists(service_account_path):
-    # For local development - credentials from file
-    credentials = service_account.Credentials.from_service_account_file(service_account_path)
-    db = firestore.Client(credentials=credentials, project=project_id)
-else:
-    # Fallback to default credentials
-    db = firestore.Client(project=project_id)
-
-def create_semantic_text(listing_data):
+def listing_metadata(listing_data):
+    """Listing fields returned with search results (everything but embeddings and bookkeeping)"""
+    return {key: value for key, value in listing_data.items() if key not in INTERNAL_FIELDS}
+
+
+# Optional comma-separated whitelist of listing fields returned by /search.
+# When set, hydration reads only these fields, so embeddings and other large
+# fields never leave Firestore; otherwise all fields but embeddings and
+# bookkeeping (INTERNAL_FIELDS) are returned.
+SEARCH_RESULT_FIELDS = [
+    field.strip() for field in os.getenv('SEARCH_RESULT_FIELDS', '').split(',') if field.strip()
+] or None
+
+
+def hydrate_matches(matches):
     """
-    Generate semantic embedding text for livestock waste listing.
+    Attach current listing data to ranked (listing id, score) pairs.
     
-    Uses livestock type as reliable context anchor and incorporates user description
-    to capture agricultural intent. Focuses on waste source, crop usability, and
-    farming relevance. Excludes pricing, payment, delivery, and logistics.
+    All matched documents are fetched in a single batched get_all call, so
+    results always reflect the latest listing fields. Listings deleted since
+    the index was loaded are dropped.
     
     Args:
-        listing_data: Dictionary containing listing information
+        matches: Ranked (listing id, score) pairs from ListingIndex.search
         
     Returns:
-        str: Clean, neutral English text optimized for agricultural semantic search
+        list: Match dicts (id, score, data) in the same order
     """
-    parts = []
-    
-    # 1. LIVESTOCK TYPE (Primary Context Anchor)
-    # This is the most reliable field - use it as the foundation
-    livestock_types = listing_data.get('livestockTypes', [])
-    if livestock_types:
-        # Normalize and expand livestock types for better matching
-        livestock_context = []
-        for livestock in livestock_types:
-            normalized = normalize_livestock_type(livestock)
-            livestock_context.append(normalized)
-            
-            # Add agricultural context for each livestock type
-            if normalized in ['chickens', 'poultry']:
-                livestock_context.append('poultry manure high nitrogen organic fertilizer')
-            elif normalized in ['cattle', 'cow']:
-                livestock_context.append('cattle manure balanced nutrients soil improvement')
-            elif normalized in ['pigs', 'swine']:
-                livestock_context.append('pig manure high phosphorus crop fertilizer')
-            elif normalized in ['goats']:
-                livestock_context.append('goat manure potassium rich vegetable fertilizer')
-            elif normalized in ['rabbits']:
-                livestock_context.append('rabbit manure gentle nutrients cold manure')
-            elif normalized in ['buffalo', 'carabao']:
-                livestock_context.append('buffalo manure organic matter paddy field fertilizer')
-            elif normalized in ['horses']:
-                livestock_context.append('horse manure mushroom substrate garden fertilizer')
-            elif normalized in ['sheep']:
-                livestock_context.append('sheep manure dry pellets organic fertilizer')
-            elif normalized in ['ducks']:
-                livestock_context.append('duck manure aquatic bird fertilizer')
-        
-        parts.extend(livestock_context)
-    
-    # 2. WASTE TYPE IDENTIFICATION
-    # Extract waste type from name or infer from context
-    name = listing_data.get('name', '').lower()
-    if 'manure' in name or 'dumi' in name:
-        parts.append('animal manure livestock waste organic fertilizer')
-    if 'compost' in name or 'composted' in name:
-        parts.append('composted organic matter soil amendment')
-    if 'egg' in name or 'itlog' in name or 'shell' in name:
-        parts.append('eggshells calcium rich poultry waste')
-    if 'bedding' in name or 'litter' in name:
-        parts.append('animal bedding livestock litter organic material')
-    if 'vermi' in name or 'worm' in name:
-        parts.append('vermicompost worm castings premium organic fertilizer')
-    
-    # 3. AGRICULTURAL INTENT FROM DESCRIPTION
-    # Clean and extract farming-relevant information only
-    description = listing_data.get('details', '') or listing_data.get('description', '')
-    if description:
-        cleaned_desc = clean_agricultural_description(description)
-        if cleaned_desc:
-            parts.append(cleaned_desc)
-    
-    # 4. GENERAL CROP SUITABILITY
-    # Add general agricultural use context if not already specified
-    if not any(crop in ' '.join(parts).lower() for crop in ['rice', 'corn', 'vegetable', 'fruit', 'crop']):
-        parts.append('suitable for crops vegetables rice corn general farming use')
-    
-    # 5. ORGANIC FARMING CONTEXT
-    # Emphasize organic and sustainable farming
-    parts.append('organic fertilizer sustainable agriculture soil health improvement')
-    
-    # 6. TAGALOG-ENGLISH MAPPINGS (for multilingual search)
-    # Add English equivalents for common Tagalog terms
-    if 'kambing' in name or 'kanding' in name:
-        parts.append('goat')
-    if 'manok' in name:
-        parts.append('chicken poultry')
-    if 'baboy' in name:
-        parts.append('pig swine')
-    if 'baka' in name:
-        parts.append('cattle cow')
-    if 'kalabaw' in name or 'kabaw' in name:
-        parts.append('buffalo carabao')
-    if 'kuneho' in name:
-        parts.append('rabbit')
-    if 'kabayo' in name:
-        parts.append('horse')
-    if 'tupa' in name:
-        parts.append('sheep')
-    if 'pato' in name:
-        parts.append('duck')
+    if not matches:
+        return []
     
-    # Join all parts and clean up
-    semantic_text = ' '.join(parts)
+    listings_ref = db.collection('livestock_listings')
+    refs = [listings_ref.document(listing_id) for listing_id, _ in matches]
+    docs = db.get_all(refs, field_paths=SEARCH_RESULT_FIELDS)
+    listings = {doc.id: doc.to_dict() for doc in docs if doc.exists}
     
-    # Remove duplicates while preserving order
-    words = semantic_text.split()
-    seen = set()
-    unique_words = []
-    for word in words:
-        word_lower = word.lower()
-        if word_lower not in seen:
-            seen.add(word_lower)
-            unique_words.append(word)
-    
-    return ' '.join(unique_words)
+    return [
+        {'id': listing_id, 'score': score, 'data': listing_metadata(listings[listing_id])}
+        for listing_id, score in matches if listing_id in listings
+    ]
+
+
+# Below ANN_MIN_LISTINGS an exact scan is both faster and exact
+listing_index = ListingIndex(ann_min_listings=int(os.getenv('ANN_MIN_LISTINGS', '20000')))
+
+class EmbedRequest(BaseModel):
+    text: str
+    # 'float' returns a JSON float list; 'float16' returns base64-packed bytes
+    encoding: str = 'float'
+
+# Most items one unauthenticated batch request may carry; re-embedding the
+# whole collection goes through the guarded /reindex-all instead
+MAX_BATCH_ITEMS = 500
+
+class BatchEmbedRequest(BaseModel):
+    texts: List[str] = Field(..., max_length=MAX_BATCH_ITEMS)
+
+class ListingEmbedRequest(BaseModel):
+    listingId: str
+
+class ListingBatchEmbedRequest(BaseModel):
+    listingIds: List[str] = Field(..., max_length=MAX_BATCH_ITEMS)
+
+class SearchRequest(BaseModel):
+    text: str
+    top_k: int = Field(10, ge=1)
+
+class EmbedResponse(BaseModel):
+    embedding: Optional[List[float]] = None
+    embedding_b64: Optional[str] = None
+    dtype: Optional[str] = None
+    dim: Optional[int] = None
+
+class BatchEmbedResponse(BaseModel):
+    embeddings: List[List[float]]
 
+class SearchResult(BaseModel):
+    id: str
+    score: float
+    data: dict
 
-def normalize_livestock_type(livestock_type):
+class SearchResponse(BaseModel):
+    matches: List[SearchResult]
+
+# MICRO_BATCH_SIZE=1 disables batching across requests
+encode_batcher = EncodeBatcher(
+    lambda texts: encode_normalized(get_model(), texts, batch_size=len(texts)),
+    max_batch_size=int(os.getenv('MICRO_BATCH_SIZE', '32')),
+    max_wait_ms=float(os.getenv('MICRO_BATCH_WAIT_MS', '5'))
+)
+
+class QueryEmbeddingCache:
     """
-    Normalize livestock type to standard format for consistent embedding generation.
+    Two-tier cache of query embeddings keyed by a hash of the query text.
     
-    Args:
-        livestock_type: Raw livestock type string
-        
-    Returns:
-        str: Normalized livestock type
+    A process-local LRU answers repeat queries without touching the model; when
+    REDIS_URL is set, a shared Redis tier (with a TTL) lets workers and
+    instances reuse each other's embeddings. Redis errors and timeouts are
+    treated as cache misses, so an outage only costs extra encodes.
     """
-    if not livestock_type:
-        return ''
     
-    normalized = livestock_type.lower().strip()
+    def __init__(self, max_size, redis_url=None, ttl_seconds=86400, redis_timeout=0.1):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.redis = None
+        self.redis_errors = ()
+        self.redis_healthy = True
+        if redis_url:
+            import redis
+            self.redis = redis.Redis.from_url(
+                redis_url, socket_timeout=redis_timeout, socket_connect_timeout=redis_timeout
+            )
+            self.redis_errors = (redis.RedisError,)
     
-    # Mapping to standard types
-    type_map = {
-        # Cattle variations
-        'cow': 'cattle',
-        'cows': 'cattle',
-        'cattle': 'cattle',
-        'beef cattle': 'cattle',
-        'dairy cattle': 'cattle',
-        'dairy cow': 'cattle',
-        'beef cow': 'cattle',
-        'baka': 'cattle',
-        
-        # Buffalo/Carabao variations
-        'carabao': 'buffalo',
-        'water buffalo': 'buffalo',
-        'buffalo': 'buffalo',
-        'kalabaw': 'buffalo',
-        'kabaw': 'buffalo',
-        
-        # Pig/Swine variations
-        'pig': 'pigs',
-        'pigs': 'pigs',
-        'swine': 'pigs',
-        'hog': 'pigs',
-        'hogs': 'pigs',
-        'baboy': 'pigs',
-        
-        # Chicken/Poultry variations
-        'chicken': 'chickens',
-        'chickens': 'chickens',
-        'poultry': 'chickens',
-        'hen': 'chickens',
-        'hens': 'chickens',
-        'rooster': 'chickens',
-        'broiler': 'chickens',
-        'layer': 'chickens',
-        'manok': 'chickens',
-        'quail': 'chickens',
-        'pugo': 'chickens',
-        'turkey': 'chickens',
-        'pabo': 'chickens',
-        'goose': 'chickens',
-        'gansa': 'chickens',
-        
-        # Goat variations
-        'goat': 'goats',
-        'goats': 'goats',
-        'kambing': 'goats',
-        'kanding': 'goats',
-        
-        # Sheep variations
-        'sheep': 'sheep',
-        'tupa': 'sheep',
+    def redis_call(self, method, *args, **kwargs):
+        """Run a Redis command, returning None (and logging once per outage) on failure"""
+        try:
+            result = getattr(self.redis, method)(*args, **kwargs)
+        except self.redis_errors as e:
+            if self.redis_healthy:
+                self.redis_healthy = False
+                print(f"Redis query cache unavailable, encoding without it: {e}")
+            return None
+        if not self.redis_healthy:
+            self.redis_healthy = True
+            print("Redis query cache reachable again")
+        return result
+    
+    def get_or_encode(self, text):
+        """Return the L2-normalized embedding of text, encoding it on a miss"""
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
         
-        # Rabbit variations
-        'rabbit': 'rabbits',
-        'rabbits': 'rabbits',
-        'kuneho': 'rabbits',
+        with self.lock:
+            embedding = self.entries.get(key)
+            if embedding is not None:
+                self.entries.move_to_end(key)
+                return embedding
         
-        # Horse variations
-        'horse': 'horses',
-        'horses': 'horses',
-        'kabayo': 'horses',
+        embedding = None
+        if self.redis is not None:
+            cached = self.redis_call('get', 'emb:' + key)
+            if cached is not None:
+                embedding = np.frombuffer(cached, dtype=np.float32)
         
-        # Duck variations
-        'duck': 'ducks',
-        'ducks': 'ducks',
-        'pato': 'ducks',
+        if embedding is None:
+            embedding = encode_batcher.encode(text).astype(np.float32)
+            if self.redis is not None:
+                self.redis_call('set', 'emb:' + key, embedding.tobytes(), ex=self.ttl_seconds)
         
-        # Other/Others - map to general livestock
-        'other': 'livestock',
-        'others': 'livestock',
-        'iba': 'livestock'
-    }
-    
-    return type_map.get(normalized, normalized)
+        # Cached arrays are shared between requests
+        embedding.flags.writeable = False
+        with self.lock:
+            self.entries[key] = embedding
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return embedding
+
+query_cache = QueryEmbeddingCache(
+    max_size=int(os.getenv('QUERY_CACHE_SIZE', '4096')),
+    redis_url=os.getenv('REDIS_URL')
+)
 
+# SEARCH_CACHE_SIZE=0 disables result reuse
+search_cache = SemanticSearchCache(
+    max_size=int(os.getenv('SEARCH_CACHE_SIZE', '1024')),
+    threshold=float(os.getenv('SEARCH_CACHE_THRESHOLD', '0.97'))
+)
 
-def clean_agricultural_description(description):
+# How the index follows Firestore: 'listen' applies real-time listener
+# changes; 'poll' reloads just the embedding fields every
+# INDEX_REFRESH_SECONDS. A listener keeps a full copy of every listing
+# document in memory (listen streams cannot project fields), so 'poll' trades
+# freshness for memory on large catalogues.
+INDEX_SYNC = os.getenv('INDEX_SYNC', 'listen')
+INDEX_REFRESH_SECONDS = float(os.getenv('INDEX_REFRESH_SECONDS', '300'))
+# How often a listen-mode worker checks that its listener is still running
+INDEX_WATCH_CHECK_SECONDS = float(os.getenv('INDEX_WATCH_CHECK_SECONDS', '30'))
+INDEX_LOAD_TIMEOUT_SECONDS = float(os.getenv('INDEX_LOAD_TIMEOUT_SECONDS', '120'))
+
+def reload_listing_index():
+    """Rebuild the search index from Firestore (blocking)"""
+    # Only the embedding fields are read; results are hydrated per search
+    listings = db.collection('livestock_listings').select(list(EMBEDDING_FIELDS))
+    listing_index.load(listings.stream())
+
+def watch_listings():
     """
-    Clean description to extract only agricultural and farming-relevant information.
-    Removes pricing, payment, delivery, and logistics details.
+    Keep the search index in sync with Firestore through a real-time listener.
+    
+    The listener's first snapshot carries every listing and reloads the index;
+    later ones carry only the listings that changed, including those embedded
+    by the ingestion script or another API instance. The callback runs on the
+    listener's own thread.
     
-    Args:
-        description: Raw description text
-        
     Returns:
-        str: Cleaned description focusing on agricultural intent
+        Watch: Listener handle; call unsubscribe() to stop it
     """
-    if not description:
-        return ''
-    
-    # Convert to lowercase for processing
-    desc_lower = description.lower()
-    
-    # Keywords to exclude (pricing, payment, delivery, logistics)
-    exclude_keywords = [
-        'price', 'cost', 'payment', 'pay', 'pesos', 'php', '₱',
-        'delivery', 'shipping', 'transport', 'pickup', 'meet',
-        'contact', 'call', 'text', 'message', 'whatsapp', 'viber',
-        'available', 'stock', 'quantity', 'kg', 'sack', 'bag',
-        'location', 'address', 'area', 'barangay', 'city',
-        'negotiable', 'fixed', 'cash', 'gcash', 'bank'
-    ]
+    initial = True
     
-    # Split into sentences
-    sentences = description.split('.')
+    def on_snapshot(docs, changes, read_time):
+        nonlocal initial
+        if initial:
+            listing_index.load(docs)
+            initial = False
+        else:
+            listing_index.apply_changes(changes)
     
-    # Keep only sentences that focus on agricultural use
-    agricultural_sentences = []
-    for sentence in sentences:
-        sentence_lower = sentence.lower().strip()
-        
-        # Skip if contains excluded keywords
-        if any(keyword in sentence_lower for keyword in exclude_keywords):
-            continue
-        
-        # Keep if contains agricultural keywords
-        agricultural_keywords = [
-            'crop', 'plant', 'farm', 'soil', 'fertilizer', 'organic',
-            'compost', 'manure', 'nutrient', 'nitrogen', 'phosphorus',
-            'potassium', 'vegetable', 'rice', 'corn', 'fruit', 'garden',
-            'grow', 'harvest', 'yield', 'quality', 'rich', 'natural',
-            'tanim', 'pananim', 'pataba', 'lupa', 'organiko'
-        ]
-        
-        if any(keyword in sentence_lower for keyword in agricultural_keywords):
-            agricultural_sentences.append(sentence.strip())
-    
-    # Join agricultural sentences
-    cleaned = ' '.join(agricultural_sentences)
+    return db.collection('livestock_listings').on_snapshot(on_snapshot)
+
+async def sync_listing_index():
+    """
+    Keep the search index current for the life of the worker.
     
-    # Remove extra whitespace
-    cleaned = ' '.join(cleaned.split())
+    In listen mode the listener is checked every INDEX_WATCH_CHECK_SECONDS.
+    The Firestore client retries transient stream errors itself but closes
+    the listener on permanent ones, so a stopped listener triggers a projected
+    reload (the index is never left frozen) and a fresh subscription. In poll
+    mode the index is reloaded every INDEX_REFRESH_SECONDS.
+    """
+    if INDEX_SYNC == 'poll':
+        while True:
+            try:
+                await asyncio.to_thread(reload_listing_index)
+            except Exception as e:
+                print(f"Search index reload failed: {e}")
+            await asyncio.sleep(INDEX_REFRESH_SECONDS)
     
-    return cleaned
-
-class EmbedRequest(BaseModel):
-    text: str
+    watch = watch_listings()
+    try:
+        while True:
+            await asyncio.sleep(INDEX_WATCH_CHECK_SECONDS)
+            if watch.is_active:
+                continue
+            
+            print("Listing listener stopped; reloading the search index and re-subscribing")
+            watch.unsubscribe()
+            try:
+                await asyncio.to_thread(reload_listing_index)
+                watch = watch_listings()
+            except Exception as e:
+                print(f"Search index resync failed: {e}")
+    finally:
+        watch.unsubscribe()
 
-class ListingEmbedRequest(BaseModel):
-    listingId: str
+# Full-collection maintenance runs (/reindex-all, /migrate-embeddings) require
+# this token in the X-Admin-Token header; they are disabled when it is unset
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
 
-class SearchRequest(BaseModel):
-    text: str
-    top_k: int = 10
+# Held for the duration of a maintenance run, so a worker never runs two at once
+maintenance_lock = threading.Lock()
 
-class EmbedResponse(BaseModel):
-    embedding: List[float]
+def require_admin(token):
+    """Reject maintenance requests without the configured admin token"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Maintenance endpoints are disabled; set ADMIN_TOKEN to enable them")
+    # Compared as bytes: compare_digest rejects non-ASCII str arguments
+    if token is None or not hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8')):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
 
-class SearchResult(BaseModel):
-    id: str
-    score: float
-    data: dict
-
-class SearchResponse(BaseModel):
-    matches: List[SearchResult]
+# Model inference and Firestore calls below are blocking, so endpoints run
+# them on worker threads (asyncio.to_thread) to keep the event loop free for
+# other requests.
 
 @app.get("/")
 async def root():
     return {"message": "AgriLink Semantic Search API is running"}
 
-@app.post("/embed", response_model=EmbedResponse)
+@app.post("/embed", response_model=EmbedResponse, response_model_exclude_none=True)
 async def get_embedding(request: EmbedRequest):
-    """Convert text to MPNet embedding"""
+    """Convert text to L2-normalized MPNet embedding"""
+    if request.encoding not in ('float', 'float16'):
+        raise HTTPException(status_code=400, detail="encoding must be 'float' or 'float16'")
+    
     try:
-        embedding = model.encode(request.text, convert_to_numpy=True)
+        embedding = await asyncio.to_thread(query_cache.get_or_encode, request.text)
+        if request.encoding == 'float16':
+            # ~1.5 KB of base64 instead of ~768 JSON floats
+            return EmbedResponse(
+                embedding_b64=base64.b64encode(embedding.astype(np.float16).tobytes()).decode('ascii'),
+                dtype='float16',
+                dim=embedding.shape[0]
+            )
         return EmbedResponse(embedding=embedding.tolist())
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/embed-batch", response_model=BatchEmbedResponse)
+async def get_embeddings(request: BatchEmbedRequest):
+    """Convert a list of texts to L2-normalized MPNet embeddings in one batched pass"""
+    try:
+        embeddings = await asyncio.to_thread(encode_normalized, get_model(), request.texts, batch_size=64)
+        return BatchEmbedResponse(embeddings=embeddings.tolist())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/reindex-all")
+async def reindex_all(x_admin_token: Optional[str] = Header(None)):
+    """Re-embed every listing whose semantic text changed, in one batched run"""
+    require_admin(x_admin_token)
+    if not maintenance_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A reindex or migration is already running")
+    
+    try:
+        # The listener picks up the rewritten embeddings as they are committed
+        counts = await asyncio.to_thread(
+            ingest_listings, model=get_model(), db=db, show_progress=False
+        )
+        return {"message": "Reindex complete", **counts}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        maintenance_lock.release()
+
+@app.post("/embed-listings-batch")
+async def embed_listings_batch(request: ListingBatchEmbedRequest):
+    """Generate and store embeddings for several listings in one batched pass"""
+    try:
+        # One get_all read, one encode call and one BulkWriter for the whole
+        # batch; the listener applies the new embeddings to the index
+        counts = await asyncio.to_thread(
+            ingest_listings, model=get_model(), db=db, listing_ids=request.listingIds, show_progress=False
+        )
+        return {"message": "Embeddings generated and stored successfully", **counts}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/migrate-embeddings")
+async def migrate_embeddings(x_admin_token: Optional[str] = Header(None)):
+    """Rewrite legacy float-list embeddings as normalized float16 bytes (no re-encoding)"""
+    require_admin(x_admin_token)
+    if not maintenance_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="A reindex or migration is already running")
+    
+    try:
+        # The listener applies the rewritten vectors to the index
+        counts = await asyncio.to_thread(migrate_legacy_embeddings, db=db, show_progress=False)
+        return {"message": "Migration complete", **counts}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        maintenance_lock.release()
+
 @app.post("/embed-listing")
 async def embed_listing(request: ListingEmbedRequest):
     """Generate and store embedding for a specific listing"""
     try:
         # Get listing from Firestore
         doc_ref = db.collection('livestock_listings').document(request.listingId)
-        doc = doc_ref.get()
+        doc = await asyncio.to_thread(doc_ref.get)
         
         if not doc.exists:
             raise HTTPException(status_code=404, detail="Listing not found")
@@ -368,14 +423,29 @@ async def embed_listing(request: ListingEmbedRequest):
         if not semantic_text.strip():
             raise HTTPException(status_code=400, detail="No content to embed")
         
+        # Skip re-encoding when the stored embedding came from the same text
+        # (the hash is only ever written together with the embedding)
+        text_hash = semantic_text_hash(semantic_text)
+        if listing_data.get('semantic_text_sha1') == text_hash:
+            return {"message": "Embedding already up to date", "listingId": request.listingId}
+        
         # Generate embedding
-        embedding = model.encode(semantic_text, convert_to_numpy=True)
+        embedding = await asyncio.to_thread(encode_batcher.encode, semantic_text)
         
-        # Update document with embedding
-        doc_ref.update({
-            'mpnet_embedding': embedding.tolist()
+        # Update document with float16-packed embedding
+        packed = embedding.astype(np.float16)
+        await asyncio.to_thread(doc_ref.update, {
+            'mpnet_embedding_f16': packed.tobytes(),
+            'mpnet_embedding': firestore.DELETE_FIELD,
+            'semantic_text_sha1': text_hash
         })
         
+        # Make the new embedding searchable right away; storing the float16
+        # value makes the listener's echo of this write a no-op. The index lock
+        # can be held by a search, and appends may grow the buffer, so this
+        # runs off the event loop too.
+        await asyncio.to_thread(listing_index.upsert, request.listingId, packed.astype(np.float32))
+        
         return {"message": "Embedding generated and stored successfully", "listingId": request.listingId}
         
     except Exception as e:
@@ -386,37 +456,16 @@ async def semantic_search(request: SearchRequest):
     """Search livestock listings by semantic similarity"""
     try:
         # Get query embedding
-        query_embedding = model.encode(request.text, convert_to_numpy=True)
-        
-        # Get all listings from Firestore
-        listings_ref = db.collection('livestock_listings')
-        docs = listings_ref.stream()
-        
-        matches = []
-        
-        for doc in docs:
-            listing_data = doc.to_dict()
-            
-            # Check if listing has embedding
-            if 'mpnet_embedding' not in listing_data:
-                continue
-                
-            stored_embedding = np.array(listing_data['mpnet_embedding'])
-            
-            # Calculate cosine similarity
-            similarity = np.dot(query_embedding, stored_embedding) / (
-                np.linalg.norm(query_embedding) * np.linalg.norm(stored_embedding)
-            )
-            
-            matches.append({
-                'id': doc.id,
-                'score': float(similarity),
-                'data': listing_data
-            })
+        query_embedding = await asyncio.to_thread(query_cache.get_or_encode, request.text)
         
-        # Sort by similarity and return top_k
-        matches.sort(key=lambda x: x['score'], reverse=True)
-        top_matches = matches[:request.top_k]
+        # Reuse the results of a near-identical recent query when the index
+        # has not changed since
+        index_version = listing_index.version
+        top_matches = search_cache.get(query_embedding, request.top_k, index_version)
+        if top_matches is None:
+            top_matches = await asyncio.to_thread(listing_index.search, query_embedding, request.top_k)
+            top_matches = await asyncio.to_thread(hydrate_matches, top_matches)
+            search_cache.put(query_embedding, request.top_k, top_matches, index_version)
         
         return SearchResponse(matches=top_matches)
         
@@ -426,4 +475,13 @@ async def semantic_search(request: SearchRequest):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv('PORT', 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # uvicorn's "auto" loop and HTTP parser pick uvloop and httptools when
+    # they are installed (uvicorn[standard] skips uvloop on Windows); each
+    # worker process loads its own model and index, and splits the CPU threads
+    # accordingly
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=int(os.getenv('WEB_CONCURRENCY', '1'))
+    )
@@ -0,0 +1,441 @@
+"""
+In-memory search structures behind the API: the listing embedding index,
+the cross-request encode batcher and the near-duplicate search result cache.
+
+Only numpy and faiss are needed here (no Firestore client or model), so the
+structures can be exercised directly by test_search_index.py.
+"""
+
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import numpy as np
+import faiss
+
+def load_stored_embedding(listing_data):
+    """
+    Read a listing's stored embedding as a float32 vector.
+    
+    Embeddings are stored L2-normalized as packed float16 bytes in
+    `mpnet_embedding_f16`; listings not yet re-embedded may still carry the
+    legacy, unnormalized float list in `mpnet_embedding`.
+    
+    Args:
+        listing_data: Dictionary containing listing information
+        
+    Returns:
+        np.ndarray or None: Stored embedding, or None if the listing has none
+    """
+    packed = listing_data.get('mpnet_embedding_f16')
+    if packed is not None:
+        return np.frombuffer(packed, dtype=np.float16).astype(np.float32)
+    
+    legacy = listing_data.get('mpnet_embedding')
+    if legacy is not None:
+        return np.asarray(legacy, dtype=np.float32)
+    
+    return None
+
+# Fields holding stored embeddings
+EMBEDDING_FIELDS = ('mpnet_embedding_f16', 'mpnet_embedding')
+
+# Bookkeeping fields written by the embedding code; never returned as listing data
+INTERNAL_FIELDS = EMBEDDING_FIELDS + ('semantic_text_sha1',)
+
+
+class ListingIndex:
+    """
+    In-memory search index over all listing embeddings.
+    
+    Keeps a contiguous float32 matrix of L2-normalized embeddings (one row per
+    listing) with a parallel id list, so a query is scored against
+    every listing with a single matrix-vector product. Once the index holds at
+    least `ann_min_listings` rows, queries go through a FAISS HNSW graph built
+    over the same matrix instead of the exhaustive scan. HNSW graphs cannot
+    replace or delete vectors, so such changes drop the graph and it is
+    rebuilt on a background thread; searches use the exact scan until the new
+    graph is ready.
+    
+    The index is loaded from the first Firestore snapshot and then kept in
+    sync by applying the listener's change events (see watch_listings in
+    main.py).
+    `embeddings` is a view of the first rows of `buffer`, whose capacity
+    doubles when full so appends are amortized O(1).
+    """
+    
+    def __init__(self, ann_min_listings):
+        self.ann_min_listings = ann_min_listings
+        self.ids = []
+        self.rows = {}
+        self.buffer = None
+        self.embeddings = None
+        self.ann = None
+        # Bumped whenever existing rows are replaced, moved or dropped, which
+        # invalidates any HNSW graph built (or being built) before the change
+        self.ann_generation = 0
+        self.ann_building = False
+        # Bumped on every change to the indexed listings (embeddings or data)
+        self.version = 0
+        self.loaded = threading.Event()
+        # Reentrant: apply_changes holds it across upsert/remove calls
+        self.lock = threading.RLock()
+    
+    def load(self, docs):
+        """Rebuild the index from an iterable of listing documents"""
+        ids, vectors = [], []
+        for doc in docs:
+            embedding = load_stored_embedding(doc.to_dict())
+            if embedding is None:
+                continue
+            ids.append(doc.id)
+            vectors.append(embedding)
+        
+        vectors = np.stack(vectors) if vectors else None
+        embeddings = normalize_rows(vectors) if vectors is not None else None
+        # A C-contiguous float32 matrix lets E @ q dispatch straight to BLAS sgemv
+        assert embeddings is None or (embeddings.dtype == np.float32 and embeddings.flags.c_contiguous)
+        
+        with self.lock:
+            if self.embeddings is not None and embeddings is not None:
+                # Reloads (polling, a re-subscribed listener) mostly repeat
+                # what is already indexed; merging keeps the HNSW graph unless
+                # rows were actually replaced or removed
+                self.merge(ids, vectors, embeddings)
+                self.version += 1
+                return
+            
+            self.ids = ids
+            self.rows = {listing_id: row for row, listing_id in enumerate(ids)}
+            self.buffer = embeddings
+            self.embeddings = embeddings
+            self.ann = None
+            self.ann_generation += 1
+            self.version += 1
+        self.loaded.set()
+    
+    def merge(self, ids, vectors, embeddings):
+        """
+        Apply a full reload as row-level changes to the current index.
+        
+        Args:
+            ids: Listing ids of the reload
+            vectors: Their stored embeddings, one row per id
+            embeddings: The same rows L2-normalized
+        """
+        with self.lock:
+            reloaded = set(ids)
+            for listing_id in [listing_id for listing_id in self.ids if listing_id not in reloaded]:
+                self.remove(listing_id)
+            
+            # Rows already indexed with the same vector need no change
+            current = np.array([self.rows.get(listing_id, -1) for listing_id in ids])
+            known = current >= 0
+            changed = ~known
+            if self.embeddings is not None and known.any():
+                changed[known] = np.any(self.embeddings[current[known]] != embeddings[known], axis=1)
+            
+            # Upserted from the stored vectors, so rows are normalized exactly
+            # as the listener would normalize them
+            for row in np.flatnonzero(changed):
+                self.upsert(ids[row], vectors[row])
+    
+    def apply_changes(self, changes):
+        """Apply Firestore listener changes (listings added, modified or removed)"""
+        with self.lock:
+            # Edits that keep the embedding still change the listing data
+            self.version += 1
+            for change in changes:
+                embedding = None
+                if change.type.name != 'REMOVED':
+                    embedding = load_stored_embedding(change.document.to_dict())
+                
+                if embedding is None:
+                    self.remove(change.document.id)
+                else:
+                    self.upsert(change.document.id, embedding)
+    
+    def upsert(self, listing_id, embedding):
+        """Insert or replace a single listing's row"""
+        vector = normalize_rows(embedding.reshape(1, -1))
+        with self.lock:
+            row = self.rows.get(listing_id)
+            if row is not None:
+                # Edits to other listing fields leave the embedding as it was
+                if np.array_equal(self.embeddings[row], vector[0]):
+                    return
+                self.embeddings[row] = vector[0]
+                # HNSW graphs cannot update a vector in place
+                self.ann = None
+                self.ann_generation += 1
+                self.version += 1
+                return
+            
+            count = len(self.ids)
+            if self.buffer is None or count == self.buffer.shape[0]:
+                buffer = np.empty((max(1024, 2 * count), vector.shape[1]), dtype=np.float32)
+                if count:
+                    buffer[:count] = self.buffer[:count]
+                self.buffer = buffer
+            self.buffer[count] = vector[0]
+            
+            self.rows[listing_id] = count
+            self.ids.append(listing_id)
+            self.embeddings = self.buffer[:count + 1]
+            if self.ann is not None:
+                self.ann.add(vector)
+            self.version += 1
+    
+    def remove(self, listing_id):
+        """Drop a listing's row, moving the last row into its place"""
+        with self.lock:
+            row = self.rows.pop(listing_id, None)
+            if row is None:
+                return
+            
+            last = len(self.ids) - 1
+            if row != last:
+                moved_id = self.ids[last]
+                self.ids[row] = moved_id
+                self.rows[moved_id] = row
+                self.embeddings[row] = self.embeddings[last]
+            self.ids.pop()
+            self.embeddings = self.buffer[:last] if last else None
+            # HNSW graphs cannot delete vectors
+            self.ann = None
+            self.ann_generation += 1
+            self.version += 1
+    
+    def search(self, query_embedding, top_k):
+        """
+        Score all listings against a query embedding.
+        
+        Args:
+            query_embedding: Query embedding (any norm)
+            top_k: Number of matches to return
+            
+        Returns:
+            list: Up to top_k (listing id, score) pairs, best first
+        """
+        with self.lock:
+            if self.embeddings is None or top_k <= 0:
+                return []
+            
+            query = query_embedding.astype(np.float32)
+            query /= np.linalg.norm(query)
+            k = min(top_k, len(self.ids))
+            
+            if len(self.ids) >= self.ann_min_listings:
+                if self.ann is not None:
+                    self.ann.hnsw.efSearch = max(64, k)
+                    scores, top = self.ann.search(query.reshape(1, -1), k)
+                    scores, top = scores[0], top[0]
+                    return [(self.ids[row], float(score)) for score, row in zip(scores, top) if row >= 0]
+                self.start_ann_build()
+            
+            top, scores = exact_top_k(self.embeddings, query, k)
+            return [(self.ids[row], float(score)) for row, score in zip(top, scores)]
+    
+    def start_ann_build(self):
+        """Start building the HNSW graph on a background thread, unless one is running"""
+        with self.lock:
+            if self.ann_building:
+                return
+            self.ann_building = True
+        threading.Thread(target=self.build_ann, name='hnsw-build', daemon=True).start()
+    
+    def build_ann(self):
+        """Build the HNSW graph from a copy of the matrix, without holding the lock"""
+        try:
+            while True:
+                with self.lock:
+                    if self.embeddings is None:
+                        return
+                    generation = self.ann_generation
+                    embeddings = self.embeddings.copy()
+                
+                ann = build_hnsw_index(embeddings)
+                
+                with self.lock:
+                    if generation == self.ann_generation:
+                        # Add the rows appended while the graph was being built
+                        built = embeddings.shape[0]
+                        if len(self.ids) > built:
+                            ann.add(self.embeddings[built:])
+                        self.ann = ann
+                        return
+                # Rows were replaced or removed during the build; start over
+        finally:
+            with self.lock:
+                self.ann_building = False
+
+
+# Rows scored per matrix-vector product in exact search; bounds the temporary
+# score array and keeps each block's working set small on huge catalogues
+SCORE_BLOCK_ROWS = 65536
+
+
+def exact_top_k(embeddings, query, k):
+    """
+    Exact inner-product top k over a float32 matrix, scored in row blocks.
+    
+    Args:
+        embeddings: C-contiguous float32 matrix, one L2-normalized row per listing
+        query: L2-normalized float32 query vector
+        k: Number of rows to return (1 <= k <= number of rows)
+        
+    Returns:
+        tuple: (row indices, scores) of the best k rows, best first
+    """
+    best_rows, best_scores = [], []
+    for start in range(0, embeddings.shape[0], SCORE_BLOCK_ROWS):
+        scores = embeddings[start:start + SCORE_BLOCK_ROWS] @ query
+        
+        # Select the block's top k in O(block), keeping only those candidates
+        block_k = min(k, scores.shape[0])
+        top = np.argpartition(-scores, block_k - 1)[:block_k]
+        best_rows.append(top + start)
+        best_scores.append(scores[top])
+    
+    rows = np.concatenate(best_rows)
+    scores = np.concatenate(best_scores)
+    order = np.argsort(-scores)[:k]
+    return rows[order], scores[order]
+
+
+def build_hnsw_index(embeddings):
+    """Build a FAISS HNSW inner-product index over L2-normalized embeddings"""
+    index = faiss.IndexHNSWFlat(embeddings.shape[1], 32, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = 200
+    index.add(embeddings)
+    return index
+
+
+def normalize_rows(vectors):
+    """Return a contiguous float32 copy of vectors scaled to unit L2 norm"""
+    vectors = np.array(vectors, dtype=np.float32, order='C')
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    vectors /= norms
+    return vectors
+
+
+class EncodeBatcher:
+    """
+    Fuses concurrent single-text encodes into batched forward passes.
+    
+    Request threads queue a text and block on a Future. One background thread
+    takes the first waiting text, collects whatever else arrives within
+    `max_wait_ms` (up to `max_batch_size` texts) and encodes them all in one
+    call to `encode_batch`, which maps a list of texts to one L2-normalized
+    row per text. The model's encode() orders each batch by length itself,
+    which keeps padding low. A `max_batch_size` of 1 encodes inline instead.
+    """
+    
+    def __init__(self, encode_batch, max_batch_size, max_wait_ms):
+        self.encode_batch = encode_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.thread = None
+    
+    def start(self):
+        """Start the batching thread (once the model is loaded)"""
+        if self.max_batch_size > 1 and self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='encode-batcher', daemon=True)
+            self.thread.start()
+    
+    def encode(self, text):
+        """Return the L2-normalized embedding of one text (blocking)"""
+        if self.thread is None:
+            return self.encode_batch([text])[0]
+        
+        future = Future()
+        self.queue.put((text, future))
+        return future.result()
+    
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                embeddings = self.encode_batch([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+
+class SemanticSearchCache:
+    """
+    Recent /search results keyed by query embedding rather than query text.
+    
+    A query whose embedding has cosine similarity of at least `threshold`
+    with a cached query reuses that query's hydrated matches. This covers
+    paraphrases, word order and punctuation that the text-keyed query cache
+    misses. Entries are tagged with the listing index version, and the cache
+    is cleared as soon as the index changes, so results are never staler than
+    the index. The oldest entry is overwritten once `max_size` is reached.
+    """
+    
+    def __init__(self, max_size, threshold):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.embeddings = None
+        self.results = [None] * max_size
+        self.count = 0
+        self.next_slot = 0
+        self.version = 0
+        self.lock = threading.Lock()
+    
+    def get(self, query_embedding, top_k, version):
+        """Return cached matches for a near-identical query, or None"""
+        if self.max_size <= 0 or top_k <= 0:
+            return None
+        
+        with self.lock:
+            if version != self.version or self.count == 0:
+                return None
+            
+            scores = self.embeddings[:self.count] @ query_embedding
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            
+            cached_top_k, matches = self.results[best]
+            if cached_top_k < top_k:
+                return None
+            return matches[:top_k]
+    
+    def put(self, query_embedding, top_k, matches, version):
+        """Store matches computed against the given index version"""
+        if self.max_size <= 0:
+            return
+        
+        with self.lock:
+            if version < self.version:
+                return
+            if version > self.version:
+                # The index changed; every cached result is stale
+                self.version = version
+                self.count = 0
+                self.next_slot = 0
+            
+            if self.embeddings is None:
+                self.embeddings = np.empty((self.max_size, query_embedding.shape[0]), dtype=np.float32)
+            self.embeddings[self.next_slot] = query_embedding
+            self.results[self.next_slot] = (top_k, matches)
+            self.next_slot = (self.next_slot + 1) % self.max_size
+            self.count = min(self.count + 1, self.max_size)
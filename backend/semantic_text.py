@@ -0,0 +1,339 @@
+import re
+import hashlib
+from functools import lru_cache
+
+
+# Mapping of livestock type spellings (English and Tagalog) to standard types
+TYPE_MAP = {
+    # Cattle variations
+    'cow': 'cattle',
+    'cows': 'cattle',
+    'cattle': 'cattle',
+    'beef cattle': 'cattle',
+    'dairy cattle': 'cattle',
+    'dairy cow': 'cattle',
+    'beef cow': 'cattle',
+    'baka': 'cattle',
+    
+    # Buffalo/Carabao variations
+    'carabao': 'buffalo',
+    'water buffalo': 'buffalo',
+    'buffalo': 'buffalo',
+    'kalabaw': 'buffalo',
+    'kabaw': 'buffalo',
+    
+    # Pig/Swine variations
+    'pig': 'pigs',
+    'pigs': 'pigs',
+    'swine': 'pigs',
+    'hog': 'pigs',
+    'hogs': 'pigs',
+    'baboy': 'pigs',
+    
+    # Chicken/Poultry variations
+    'chicken': 'chickens',
+    'chickens': 'chickens',
+    'poultry': 'chickens',
+    'hen': 'chickens',
+    'hens': 'chickens',
+    'rooster': 'chickens',
+    'broiler': 'chickens',
+    'layer': 'chickens',
+    'manok': 'chickens',
+    'quail': 'chickens',
+    'pugo': 'chickens',
+    'turkey': 'chickens',
+    'pabo': 'chickens',
+    'goose': 'chickens',
+    'gansa': 'chickens',
+    
+    # Goat variations
+    'goat': 'goats',
+    'goats': 'goats',
+    'kambing': 'goats',
+    'kanding': 'goats',
+    
+    # Sheep variations
+    'sheep': 'sheep',
+    'tupa': 'sheep',
+    
+    # Rabbit variations
+    'rabbit': 'rabbits',
+    'rabbits': 'rabbits',
+    'kuneho': 'rabbits',
+    
+    # Horse variations
+    'horse': 'horses',
+    'horses': 'horses',
+    'kabayo': 'horses',
+    
+    # Duck variations
+    'duck': 'ducks',
+    'ducks': 'ducks',
+    'pato': 'ducks',
+    
+    # Other/Others - map to general livestock
+    'other': 'livestock',
+    'others': 'livestock',
+    'iba': 'livestock'
+}
+
+
+def normalize_livestock_type(livestock_type):
+    """
+    Normalize livestock type to standard format for consistent embedding generation.
+    
+    Args:
+        livestock_type: Raw livestock type string
+        
+    Returns:
+        str: Normalized livestock type
+    """
+    if not livestock_type:
+        return ''
+    
+    normalized = livestock_type.lower().strip()
+    
+    return TYPE_MAP.get(normalized, normalized)
+
+
+# Keywords to exclude (pricing, payment, delivery, logistics)
+EXCLUDE_KEYWORDS = frozenset([
+    'price', 'cost', 'payment', 'pay', 'pesos', 'php', '₱',
+    'delivery', 'shipping', 'transport', 'pickup', 'meet',
+    'contact', 'call', 'text', 'message', 'whatsapp', 'viber',
+    'available', 'stock', 'quantity', 'kg', 'sack', 'bag',
+    'location', 'address', 'area', 'barangay', 'city',
+    'negotiable', 'fixed', 'cash', 'gcash', 'bank'
+])
+
+# Keywords marking a sentence as agriculturally relevant
+AGRICULTURAL_KEYWORDS = frozenset([
+    'crop', 'plant', 'farm', 'soil', 'fertilizer', 'organic',
+    'compost', 'manure', 'nutrient', 'nitrogen', 'phosphorus',
+    'potassium', 'vegetable', 'rice', 'corn', 'fruit', 'garden',
+    'grow', 'harvest', 'yield', 'quality', 'rich', 'natural',
+    'tanim', 'pananim', 'pataba', 'lupa', 'organiko'
+])
+
+
+# Precompiled alternations so each sentence is scanned once per keyword set
+EXCLUDE_PATTERN = re.compile('|'.join(map(re.escape, sorted(EXCLUDE_KEYWORDS))))
+AGRICULTURAL_PATTERN = re.compile('|'.join(map(re.escape, sorted(AGRICULTURAL_KEYWORDS))))
+
+
+def clean_agricultural_description(description):
+    """
+    Clean description to extract only agricultural and farming-relevant information.
+    Removes pricing, payment, delivery, and logistics details.
+    
+    Args:
+        description: Raw description text
+        
+    Returns:
+        str: Cleaned description focusing on agricultural intent
+    """
+    if not description:
+        return ''
+    
+    # Convert to lowercase for processing
+    desc_lower = description.lower()
+    
+    # Split into sentences
+    sentences = description.split('.')
+    
+    # Keep only sentences that focus on agricultural use
+    agricultural_sentences = []
+    for sentence in sentences:
+        sentence_lower = sentence.lower().strip()
+        
+        # Skip if contains excluded keywords
+        if EXCLUDE_PATTERN.search(sentence_lower):
+            continue
+        
+        # Keep if contains agricultural keywords
+        if AGRICULTURAL_PATTERN.search(sentence_lower):
+            agricultural_sentences.append(sentence.strip())
+    
+    # Join agricultural sentences
+    cleaned = ' '.join(agricultural_sentences)
+    
+    # Remove extra whitespace
+    cleaned = ' '.join(cleaned.split())
+    
+    return cleaned
+
+
+# Waste types recognised in listing names: (name keywords, semantic phrase)
+WASTE_TYPES = [
+    (('manure', 'dumi'), 'animal manure livestock waste organic fertilizer'),
+    (('compost',), 'composted organic matter soil amendment'),
+    (('egg', 'itlog', 'shell'), 'eggshells calcium rich poultry waste'),
+    (('bedding', 'litter'), 'animal bedding livestock litter organic material'),
+    (('vermi', 'worm'), 'vermicompost worm castings premium organic fertilizer')
+]
+WASTE_TYPE_BY_KEYWORD = {
+    keyword: index for index, (keywords, _) in enumerate(WASTE_TYPES) for keyword in keywords
+}
+WASTE_TYPE_PATTERN = re.compile('(?=(' + '|'.join(map(re.escape, WASTE_TYPE_BY_KEYWORD)) + '))')
+
+# Agricultural context added for each normalized livestock type
+LIVESTOCK_CONTEXT = {
+    'chickens': 'poultry manure high nitrogen organic fertilizer',
+    'poultry': 'poultry manure high nitrogen organic fertilizer',
+    'cattle': 'cattle manure balanced nutrients soil improvement',
+    'cow': 'cattle manure balanced nutrients soil improvement',
+    'pigs': 'pig manure high phosphorus crop fertilizer',
+    'swine': 'pig manure high phosphorus crop fertilizer',
+    'goats': 'goat manure potassium rich vegetable fertilizer',
+    'rabbits': 'rabbit manure gentle nutrients cold manure',
+    'buffalo': 'buffalo manure organic matter paddy field fertilizer',
+    'carabao': 'buffalo manure organic matter paddy field fertilizer',
+    'horses': 'horse manure mushroom substrate garden fertilizer',
+    'sheep': 'sheep manure dry pellets organic fertilizer',
+    'ducks': 'duck manure aquatic bird fertilizer'
+}
+
+# Word cap for semantic text; ~96 words stays within MPNet's 128-token window
+MAX_SEMANTIC_WORDS = 96
+
+# Generic context closing every semantic text, prebuilt for both outcomes of
+# the crop suitability fallback
+ORGANIC_FARMING_CONTEXT = 'organic fertilizer sustainable agriculture soil health improvement'
+CROP_FALLBACK_SUFFIX = 'suitable for crops vegetables rice corn general farming use ' + ORGANIC_FARMING_CONTEXT
+
+# Words showing that a part already states crop suitability
+CROP_KEYWORDS = frozenset(['rice', 'corn', 'vegetable', 'fruit', 'crop'])
+CROP_PATTERN = re.compile('|'.join(map(re.escape, sorted(CROP_KEYWORDS))))
+
+
+def mentions_crop(text):
+    """Return True if lowercase text mentions any crop keyword."""
+    return CROP_PATTERN.search(text) is not None
+
+
+def livestock_expansion(livestock, context):
+    """Deduplicated 'type + context' text and whether it mentions a crop."""
+    expansion = ' '.join(dict.fromkeys(f'{livestock} {context}'.split()))
+    return expansion, mentions_crop(expansion)
+
+# Prebuilt expansion for each known livestock type
+LIVESTOCK_EXPANSIONS = {
+    livestock: livestock_expansion(livestock, context)
+    for livestock, context in LIVESTOCK_CONTEXT.items()
+}
+
+# English equivalents for common Tagalog terms in listing names (for multilingual search)
+TAGALOG_MAPPINGS = {
+    'kambing': 'goat',
+    'kanding': 'goat',
+    'manok': 'chicken poultry',
+    'baboy': 'pig swine',
+    'baka': 'cattle cow',
+    'kalabaw': 'buffalo carabao',
+    'kabaw': 'buffalo carabao',
+    'kuneho': 'rabbit',
+    'kabayo': 'horse',
+    'tupa': 'sheep',
+    'pato': 'duck'
+}
+TAGALOG_ORDER = {keyword: index for index, keyword in enumerate(TAGALOG_MAPPINGS)}
+
+# Single-pass scanner for all Tagalog keywords; the lookahead reports
+# overlapping hits, matching the semantics of one `in` test per keyword
+TAGALOG_PATTERN = re.compile('(?=(' + '|'.join(map(re.escape, TAGALOG_MAPPINGS)) + '))')
+
+
+def create_semantic_text(listing_data):
+    """
+    Generate semantic embedding text for livestock waste listing.
+    
+    Uses livestock type as reliable context anchor and incorporates user description
+    to capture agricultural intent. Focuses on waste source, crop usability, and
+    farming relevance. Excludes pricing, payment, delivery, and logistics.
+    
+    Args:
+        listing_data: Dictionary containing listing information
+        
+    Returns:
+        str: Clean, neutral English text optimized for agricultural semantic search
+    """
+    return _build_semantic_text(
+        listing_data.get('name', ''),
+        tuple(listing_data.get('livestockTypes', []) or ()),
+        listing_data.get('details', '') or listing_data.get('description', '')
+    )
+
+
+# Listings whose name, livestock types and description are unchanged (repeat
+# /embed-listing calls, reindex runs in a long-lived process) reuse their text
+@lru_cache(maxsize=8192)
+def _build_semantic_text(name, livestock_types, description):
+    """Build the semantic text from the listing fields that feed it (cached)"""
+    parts = []
+    # Tracked as parts are added, for the crop suitability fallback below
+    crop_mentioned = False
+    
+    # 1. LIVESTOCK TYPE (Primary Context Anchor)
+    # This is the most reliable field - use it as the foundation
+    if livestock_types:
+        # Normalize and expand livestock types with their agricultural context
+        for livestock in livestock_types:
+            normalized = normalize_livestock_type(livestock)
+            expansion = LIVESTOCK_EXPANSIONS.get(normalized)
+            if expansion is None:
+                expansion = (normalized, mentions_crop(normalized))
+            parts.append(expansion[0])
+            crop_mentioned = crop_mentioned or expansion[1]
+    
+    # 2. WASTE TYPE IDENTIFICATION
+    # Extract waste type from name or infer from context (none of these mention crops)
+    name = name.lower()
+    waste_hits = {WASTE_TYPE_BY_KEYWORD[keyword] for keyword in WASTE_TYPE_PATTERN.findall(name)}
+    for index in sorted(waste_hits):
+        parts.append(WASTE_TYPES[index][1])
+    
+    # 3. TAGALOG-ENGLISH MAPPINGS (for multilingual search)
+    # Add English equivalents for common Tagalog terms, in mapping order
+    tagalog_hits = set(TAGALOG_PATTERN.findall(name))
+    for keyword in sorted(tagalog_hits, key=TAGALOG_ORDER.get):
+        parts.append(TAGALOG_MAPPINGS[keyword])
+    
+    # 4. AGRICULTURAL INTENT FROM DESCRIPTION
+    # Clean and extract farming-relevant information only
+    if description:
+        cleaned_desc = clean_agricultural_description(description)
+        if cleaned_desc:
+            parts.append(cleaned_desc)
+            crop_mentioned = crop_mentioned or mentions_crop(cleaned_desc.lower())
+    
+    # 5-6. GENERAL CROP SUITABILITY + ORGANIC FARMING CONTEXT
+    # Add general agricultural use context if not already specified, then
+    # emphasize organic and sustainable farming
+    parts.append(ORGANIC_FARMING_CONTEXT if crop_mentioned else CROP_FALLBACK_SUFFIX)
+    
+    # Join all parts and clean up
+    semantic_text = ' '.join(parts)
+    
+    # Lowercase and remove duplicates while preserving order, then cap the
+    # length so the model's own truncation never cuts into the listing's
+    # specific signals (they come first; generic context comes last)
+    unique_words = list(dict.fromkeys(semantic_text.lower().split()))
+    return ' '.join(unique_words[:MAX_SEMANTIC_WORDS])
+
+def semantic_text_hash(semantic_text):
+    """
+    Fingerprint a semantic text for change detection.
+    
+    The hash is taken over the generated text rather than the raw listing, so
+    edits to fields that do not feed the text, and changes to
+    create_semantic_text that leave a listing's text as it was, never force
+    a re-encode.
+    
+    Args:
+        semantic_text: Output of create_semantic_text
+        
+    Returns:
+        str: Hex SHA-1 digest stored as `semantic_text_sha1`
+    """
+    return hashlib.sha1(semantic_text.encode('utf-8')).hexdigest()
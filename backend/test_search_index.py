@@ -0,0 +1,267 @@
+"""
+Tests for the in-memory search structures in search_index.py.
+
+Listings are fed in as fake Firestore snapshot documents and change events,
+and encoders are plain functions, so neither Firestore nor the model is
+needed. Run with `python test_search_index.py` or pytest.
+"""
+
+import time
+import threading
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import search_index
+from search_index import ListingIndex, EncodeBatcher, SemanticSearchCache, exact_top_k
+
+DIM = 16
+
+class FakeDoc:
+    """Stand-in for a Firestore DocumentSnapshot"""
+
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self.data = data
+
+    def to_dict(self):
+        return dict(self.data)
+
+def listing_doc(doc_id, vector):
+    """A listing document carrying a float16-packed embedding"""
+    return FakeDoc(doc_id, {'name': doc_id, 'mpnet_embedding_f16': vector.astype(np.float16).tobytes()})
+
+def change(kind, doc):
+    """Stand-in for a Firestore DocumentChange"""
+    return SimpleNamespace(type=SimpleNamespace(name=kind), document=doc)
+
+def unit(vector):
+    return vector / np.linalg.norm(vector)
+
+def brute_force(reference, query, k):
+    """Exact top-k ids over a {listing id: vector} dict"""
+    query = unit(query.astype(np.float32))
+    scored = sorted(((float(unit(vector) @ query), listing_id) for listing_id, vector in reference.items()), reverse=True)
+    return [listing_id for _, listing_id in scored[:k]]
+
+def stored(vector):
+    """The float32 vector the index holds after the float16 round trip"""
+    return vector.astype(np.float16).astype(np.float32)
+
+def test_exact_top_k_matches_full_sort_across_blocks():
+    rng = np.random.default_rng(0)
+    embeddings = np.ascontiguousarray(unit(rng.normal(size=(50, DIM))).astype(np.float32))
+    query = unit(rng.normal(size=DIM)).astype(np.float32)
+
+    block_rows = search_index.SCORE_BLOCK_ROWS
+    search_index.SCORE_BLOCK_ROWS = 7
+    try:
+        for k in (1, 5, 50):
+            rows, scores = exact_top_k(embeddings, query, k)
+            expected = np.argsort(-(embeddings @ query))[:k]
+            assert list(rows) == list(expected)
+            assert np.all(np.diff(scores) <= 0)
+    finally:
+        search_index.SCORE_BLOCK_ROWS = block_rows
+
+def test_index_tracks_random_changes():
+    rng = np.random.default_rng(1)
+    reference = {f'l{i}': stored(rng.normal(size=DIM)) for i in range(40)}
+    index = ListingIndex(ann_min_listings=10**9)
+    index.load(listing_doc(listing_id, vector) for listing_id, vector in reference.items())
+    assert index.loaded.is_set()
+
+    next_id = 40
+    for step in range(1500):
+        action = rng.integers(3)
+        if action == 0 or not reference:
+            listing_id = f'l{next_id}'
+            next_id += 1
+            reference[listing_id] = stored(rng.normal(size=DIM))
+            index.apply_changes([change('ADDED', listing_doc(listing_id, reference[listing_id]))])
+        elif action == 1:
+            listing_id = rng.choice(sorted(reference))
+            reference[listing_id] = stored(rng.normal(size=DIM))
+            index.apply_changes([change('MODIFIED', listing_doc(listing_id, reference[listing_id]))])
+        else:
+            listing_id = rng.choice(sorted(reference))
+            del reference[listing_id]
+            index.apply_changes([change('REMOVED', FakeDoc(listing_id, {}))])
+
+        # Row mapping and matrix stay consistent after swap-deletes and growth
+        assert len(index.ids) == len(reference) == len(index.rows)
+        for row, listing_id in enumerate(index.ids):
+            assert index.rows[listing_id] == row
+            assert np.allclose(index.embeddings[row], unit(reference[listing_id]), atol=1e-6)
+
+        if step % 50 == 0:
+            query = rng.normal(size=DIM).astype(np.float32)
+            k = min(5, len(reference))
+            assert [listing_id for listing_id, _ in index.search(query, 5)] == brute_force(reference, query, k)
+
+def test_index_grows_its_buffer_past_capacity():
+    rng = np.random.default_rng(2)
+    index = ListingIndex(ann_min_listings=10**9)
+    index.load([])
+    vectors = {f'l{i}': stored(rng.normal(size=DIM)) for i in range(2500)}
+    for listing_id, vector in vectors.items():
+        index.upsert(listing_id, vector)
+
+    assert index.buffer.shape[0] >= 2500
+    assert index.embeddings.shape == (2500, DIM)
+    query = rng.normal(size=DIM).astype(np.float32)
+    assert [listing_id for listing_id, _ in index.search(query, 3)] == brute_force(vectors, query, 3)
+
+def test_index_version_and_unchanged_upserts():
+    vector = stored(np.arange(1, DIM + 1, dtype=np.float32))
+    index = ListingIndex(ann_min_listings=10**9)
+    index.load([listing_doc('a', vector)])
+    version = index.version
+
+    # Same vector again (an edit to other fields): the row is left alone
+    index.upsert('a', vector)
+    assert index.version == version
+
+    # The listener still bumps the version, since the listing data changed
+    index.apply_changes([change('MODIFIED', listing_doc('a', vector))])
+    assert index.version > version
+
+    # Losing the embedding removes the listing
+    index.apply_changes([change('MODIFIED', FakeDoc('a', {'name': 'a'}))])
+    assert index.ids == [] and index.search(vector, 3) == []
+
+def test_hnsw_is_built_in_the_background():
+    rng = np.random.default_rng(3)
+    reference = {f'l{i}': stored(rng.normal(size=DIM)) for i in range(200)}
+    index = ListingIndex(ann_min_listings=100)
+    index.load(listing_doc(listing_id, vector) for listing_id, vector in reference.items())
+
+    # The first search answers exactly and starts the build
+    query = reference['l7']
+    assert index.search(query, 1)[0][0] == 'l7'
+    for _ in range(100):
+        if index.ann is not None:
+            break
+        time.sleep(0.05)
+    assert index.ann is not None and index.ann.ntotal == 200
+    assert index.search(query, 1)[0][0] == 'l7'
+
+    # Appends go straight into the graph; removals drop it until rebuilt
+    index.upsert('new', -query)
+    assert index.ann.ntotal == 201 and index.search(-query, 1)[0][0] == 'new'
+    index.remove('l7')
+    assert index.ann is None
+    assert 'l7' not in [listing_id for listing_id, _ in index.search(query, 5)]
+
+def test_reload_keeps_the_graph_unless_rows_change():
+    rng = np.random.default_rng(5)
+    reference = {f'l{i}': rng.normal(size=DIM).astype(np.float32) for i in range(200)}
+    index = ListingIndex(ann_min_listings=100)
+    index.load(listing_doc(listing_id, vector) for listing_id, vector in reference.items())
+    index.start_ann_build()
+    for _ in range(100):
+        if index.ann is not None:
+            break
+        time.sleep(0.05)
+    ann, generation, version = index.ann, index.ann_generation, index.version
+
+    # An identical reload (as in poll mode) keeps the graph but still bumps
+    # the version, since listing data may have changed
+    index.load(listing_doc(listing_id, vector) for listing_id, vector in reversed(list(reference.items())))
+    assert index.ann is ann and index.ann_generation == generation
+    assert index.version > version
+
+    # New listings are appended to the graph
+    reference['new'] = rng.normal(size=DIM).astype(np.float32)
+    index.load(listing_doc(listing_id, vector) for listing_id, vector in reference.items())
+    assert index.ann is ann and index.ann.ntotal == 201
+
+    # Replaced and removed listings drop it; the index matches the reload
+    reference['l3'] = rng.normal(size=DIM).astype(np.float32)
+    del reference['l4']
+    index.load(listing_doc(listing_id, vector) for listing_id, vector in reference.items())
+    assert index.ann is None
+    assert sorted(index.ids) == sorted(reference)
+    for listing_id, vector in reference.items():
+        assert np.allclose(index.embeddings[index.rows[listing_id]], unit(stored(vector)), atol=1e-6)
+
+def test_search_cache_reuse_rules():
+    rng = np.random.default_rng(4)
+    cache = SemanticSearchCache(max_size=4, threshold=0.97)
+    query = unit(rng.normal(size=DIM)).astype(np.float32)
+    matches = [{'id': f'l{i}'} for i in range(10)]
+    cache.put(query, 10, matches, version=1)
+
+    # Near-identical query with the same or a smaller top_k reuses the result
+    nearby = unit(query + 0.01 * rng.normal(size=DIM)).astype(np.float32)
+    assert cache.get(nearby, 10, version=1) == matches
+    assert cache.get(nearby, 3, version=1) == matches[:3]
+    # A larger top_k, an unrelated query or a newer index version misses
+    assert cache.get(query, 11, version=1) is None
+    assert cache.get(unit(rng.normal(size=DIM)).astype(np.float32), 5, version=1) is None
+    assert cache.get(query, 5, version=2) is None
+    # Non-positive top_k never hits (the index returns no matches for it)
+    assert cache.get(nearby, 0, version=1) is None
+    assert cache.get(nearby, -1, version=1) is None
+
+    # Results computed against an older index are not stored
+    cache.put(query, 10, matches, version=2)
+    cache.put(nearby, 10, [], version=1)
+    assert cache.get(nearby, 10, version=2) == matches
+
+    # The oldest entry is overwritten once full
+    others = [unit(rng.normal(size=DIM)).astype(np.float32) for _ in range(4)]
+    for other in others:
+        cache.put(other, 1, [{'id': 'x'}], version=2)
+    assert cache.get(query, 1, version=2) is None
+    assert cache.get(others[-1], 1, version=2) == [{'id': 'x'}]
+
+def test_encode_batcher_batches_concurrent_texts():
+    batch_sizes = []
+    lock = threading.Lock()
+
+    def encode_batch(texts):
+        with lock:
+            batch_sizes.append(len(texts))
+        return np.array([[len(text), 0.0] for text in texts])
+
+    batcher = EncodeBatcher(encode_batch, max_batch_size=8, max_wait_ms=50)
+    # Before start() texts are encoded inline
+    assert batcher.encode('abc')[0] == 3
+    batcher.start()
+
+    texts = ['x' * i for i in range(1, 21)]
+    with ThreadPoolExecutor(max_workers=20) as executor:
+        results = list(executor.map(batcher.encode, texts))
+
+    assert [int(result[0]) for result in results] == list(range(1, 21))
+    assert max(batch_sizes[1:]) <= 8 and len(batch_sizes) - 1 < 20
+
+def test_encode_batcher_propagates_errors():
+    def encode_batch(texts):
+        if 'bad' in texts:
+            raise ValueError('encode failed')
+        return np.zeros((len(texts), 2))
+
+    batcher = EncodeBatcher(encode_batch, max_batch_size=4, max_wait_ms=50)
+    batcher.start()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(batcher.encode, text) for text in ('bad', 'good')]
+
+    errors = [future.exception() for future in futures]
+    assert isinstance(errors[0], ValueError)
+    # Texts batched with the failing one see the same error; later ones still work
+    assert errors[1] is None or isinstance(errors[1], ValueError)
+    assert batcher.encode('fine').shape == (2,)
+
+def main():
+    """Run every test in this file"""
+    tests = [value for name, value in sorted(globals().items()) if name.startswith('test_')]
+    for test in tests:
+        test()
+        print(f"✅ {test.__name__}")
+    print(f"\n{len(tests)} tests passed")
+
+if __name__ == "__main__":
+    main()